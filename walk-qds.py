@@ -13,7 +13,7 @@
 # limitations under the License.
 
 import argparse
-import collections
+import concurrent.futures
 import os
 import re
 import sys
@@ -21,20 +21,121 @@ import sys
 import lxml.etree
 
 
-quality_level_re = re.compile(r'.*claims to be in the \*\*Quality Level ([1-5])\*\*')
+quality_level_re = re.compile(br'claims to be in the \*\*Quality Level ([1-5])\*\*')
 
 
 class Package:
     """Class to represent one package in the hierarchy of packages."""
 
-    __slots__ = ('name', 'qd_path', 'lxml_tree', 'depth', 'children')
+    __slots__ = ('name', 'qd_path', 'deps', 'depth', 'children', 'qd_found', 'quality_level', 'qd_warning')
 
-    def __init__(self, name, qd_path, lxml_tree):
+    def __init__(self, name, qd_path, deps):
         self.name = name
         self.qd_path = qd_path
-        self.lxml_tree = lxml_tree
+        self.deps = deps
         self.depth = 0
         self.children = []
+        self.qd_found = False
+        self.quality_level = None
+        self.qd_warning = None
+
+
+def find_package_xmls(source_path):
+    """Generator to yield the path of every package.xml underneath source_path."""
+    dirs_to_examine = [source_path]
+    while dirs_to_examine:
+        dirpath = dirs_to_examine.pop()
+        # Like os.walk, quietly skip any directories we can't read.
+        try:
+            it = os.scandir(dirpath)
+        except OSError:
+            continue
+
+        with it:
+            for entry in it:
+                # Hidden directories (like .git) never contain packages we
+                # care about, so don't bother descending into them.
+                if entry.name.startswith('.'):
+                    continue
+
+                # Likewise for the colcon build artifact directories, which
+                # only ever live at the top of the workspace.  Anywhere deeper
+                # these are ordinary directories that may hold packages.
+                if dirpath == source_path and entry.name in ('build', 'install', 'log'):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    dirs_to_examine.append(entry.path)
+                elif entry.name == 'package.xml':
+                    yield entry.path
+
+
+def parse_package_xml(package_xml_path, dep_tags, exclude=frozenset()):
+    """Return the package name and the list of dependencies (of the given tags) from a package.xml.
+
+    If the package name is in exclude, parsing stops as soon as the name is
+    found and the dependency list is left incomplete.
+    """
+    name = None
+    deps = []
+    # Stream through the file rather than building the whole tree, clearing
+    # out each element once we've looked at it so that we never hold more
+    # than a handful of elements in memory.
+    for _, elem in lxml.etree.iterparse(package_xml_path, events=('end',), tag=('name',) + dep_tags):
+        parent = elem.getparent()
+        # Only direct children of the top-level <package> element count.
+        if parent is not None and parent.getparent() is None:
+            if elem.tag == 'name':
+                if name is None:
+                    name = elem.text
+                    if name in exclude:
+                        break
+            else:
+                deps.append(elem.text)
+
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+    return (name, deps)
+
+
+def get_quality_level(package):
+    """Return a (declaration found, quality level, warning) tuple for a package.
+
+    Exactly one of the quality level and the warning is None.
+    """
+    if not os.path.exists(package.qd_path):
+        return (False, None, "WARNING: Could not find quality declaration for package '%s', skipping" % (package.name))
+
+    # Quality declarations are small, so just search the whole thing at once.
+    # The pattern is pure ASCII, so search the raw bytes rather than paying to
+    # decode the file.
+    with open(package.qd_path, 'rb') as infp:
+        match = quality_level_re.search(infp.read())
+
+    if match is None:
+        return (True, None, "WARNING: Could not find quality level for package '%s', skipping" % (package.name))
+
+    return (True, match.group(1)[0] - ord('0'), None)
+
+
+def load_quality_levels(packages):
+    """Fill in the quality level of each of the given packages."""
+    if not packages:
+        return
+
+    # Reading the quality declarations is independent, I/O-bound work, so
+    # overlap it across a pool of threads.  The warnings are stored on the
+    # packages rather than printed, so that callers can print them in a
+    # deterministic order, and only for the packages they actually report on.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(packages))) as executor:
+        results = list(executor.map(get_quality_level, packages))
+
+    for (package, (qd_found, ql, warning)) in zip(packages, results):
+        package.qd_found = qd_found
+        package.quality_level = ql
+        package.qd_warning = warning
 
 
 def print_package_levels(args, package_name_to_package):
@@ -44,10 +145,6 @@ def print_package_levels(args, package_name_to_package):
         print("Package name '%s' must not be in the exclude list" % (package_name_to_examine))
         return 1
 
-    dep_tags_to_consider = ['depend', 'exec_depend']
-    if args.include_build_deps:
-        dep_tags_to_consider.append('build_depend')
-
     if package_name_to_examine not in package_name_to_package:
         print("Could not find package to examine '%s'" % (package_name_to_examine))
         return 2
@@ -55,88 +152,88 @@ def print_package_levels(args, package_name_to_package):
     # Starting with the package given by the user on the command-line, walk the
     # package dependencies in a breadth-first manner.  We want breadth-first so
     # that if a dependency shows up on more than one "level", we'll only show
-    # it at the highest level it is a dependency at.
+    # it at the highest level it is a dependency at.  We keep track of every
+    # package we find so that we can look up all of their quality levels in
+    # one go afterwards.
 
-    packages_to_examine = collections.deque([package_name_to_examine])
-    depnames_found = [package_name_to_examine]
-    deps_not_found = set()
-    while packages_to_examine:
-        package = package_name_to_package[packages_to_examine.popleft()]
-        for child in package.lxml_tree.getroot().getchildren():
-            if child.tag not in dep_tags_to_consider:
-                continue
+    root_package = package_name_to_package[package_name_to_examine]
+    packages_found = [root_package]
 
-            depname = child.text
+    packages_to_examine = [root_package]
+    head = 0
+    depnames_found = {package_name_to_examine}
+    deps_not_found = set()
+    while head < len(packages_to_examine):
+        package = packages_to_examine[head]
+        head += 1
+        for depname in package.deps:
             if depname in depnames_found:
                 continue
 
             if depname in args.exclude:
                 continue
 
-            depnames_found.append(depname)
+            depnames_found.add(depname)
 
             if depname in package_name_to_package:
-                package_name_to_package[depname].depth = package.depth + 1
-                package.children.append(package_name_to_package[depname])
+                dep_package = package_name_to_package[depname]
+                dep_package.depth = package.depth + 1
+                packages_found.append(dep_package)
+                package.children.append(dep_package)
                 if args.recurse:
-                    packages_to_examine.append(depname)
+                    packages_to_examine.append(dep_package)
             else:
                 deps_not_found.add(depname)
 
     if deps_not_found:
         print("WARNING: Could not find dependencies '%s', skipping" % (', '.join(deps_not_found)))
 
+    load_quality_levels(packages_found)
+
     # Now start walking in a depth-first search, starting from the top element,
-    # figuring out the quality levels as we go.  Note that we don't do the
-    # printing here, just so that we collect all of the WARNINGS before we
-    # print out the entire tree.
-    deps_to_print = collections.deque([package_name_to_package[package_name_to_examine]])
+    # building up the lines to print.  Note that we don't do the printing here,
+    # just so that we collect all of the WARNINGS before we print out the
+    # entire tree.
+    deps_to_print = [root_package]
     strings_to_print = []
     while deps_to_print:
-        package = deps_to_print.popleft()
-        if not os.path.exists(package.qd_path):
-            print("WARNING: Could not find quality declaration for package '%s', skipping" % (package.name))
+        package = deps_to_print.pop()
+        if package.qd_warning is not None:
+            print(package.qd_warning)
+
+        # A package without a quality declaration at all cuts off its
+        # subtree, but one that just lacks a quality level still has its
+        # dependencies printed.
+        if not package.qd_found:
             continue
-        with open(package.qd_path, 'r') as infp:
-            for line in infp:
-                match = re.match(quality_level_re, line)
-                if match is None:
-                    continue
-                groups = match.groups()
-                if len(groups) != 1:
-                    continue
-                strings_to_print.append('%s%s: %d' % ('  ' * package.depth, package.name, int(groups[0])))
-                break
-            else:
-                print("WARNING: Could not find quality level for package '%s', skipping" % (package.name))
 
-        deps_to_print.extendleft(package.children)
+        if package.quality_level is not None:
+            strings_to_print.append('%s%s: %d' % ('  ' * package.depth, package.name, package.quality_level))
+
+        # Push the children in reverse so that they are popped, and hence
+        # printed, in the order they were declared in the package.xml.
+        deps_to_print.extend(reversed(package.children))
 
-    [print(s) for s in strings_to_print]
+    if strings_to_print:
+        sys.stdout.write('\n'.join(strings_to_print) + '\n')
 
 
 def count_package_levels(args, package_name_to_package):
     ql_totals = {}
-    for package in package_name_to_package.values():
-        if not os.path.exists(package.qd_path):
-            print("WARNING: Could not find quality declaration for package '%s', skipping" % (package.name))
+    packages = list(package_name_to_package.values())
+    load_quality_levels(packages)
+    for package in packages:
+        if package.qd_warning is not None:
+            print(package.qd_warning)
+
+        ql = package.quality_level
+        if ql is None:
             continue
-        with open(package.qd_path, 'r') as infp:
-            for line in infp:
-                match = re.match(quality_level_re, line)
-                if match is None:
-                    continue
-                groups = match.groups()
-                if len(groups) != 1:
-                    continue
-                ql = int(groups[0])
-                if ql in ql_totals:
-                    ql_totals[ql] += 1
-                else:
-                    ql_totals[ql] = 1
-                break
-            else:
-                print("WARNING: Could not find quality level for package '%s', skipping" % (package.name))
+
+        if ql in ql_totals:
+            ql_totals[ql] += 1
+        else:
+            ql_totals[ql] = 1
 
     print("# Package counts by quality level:")
     for level in sorted(ql_totals.keys()):
@@ -152,7 +249,7 @@ def main():
     subparsers = parser.add_subparsers(help='help for subcommand')
 
     count_parser = subparsers.add_parser('count', help='Count the number of packages in each quality level')
-    count_parser.set_defaults(func=count_package_levels)
+    count_parser.set_defaults(func=count_package_levels, exclude=[], include_build_deps=False)
 
     package_parser = subparsers.add_parser('package', help='Print the quality level of a package and its dependencies')
     package_parser.add_argument(
@@ -180,27 +277,30 @@ def main():
 
     # Walk the entire source_path passed in by the user, looking for all of the
     # package.xml files.  For each of them we parse the package.xml, and go
-    # looking for the name of the package.  We then save that off, along with
-    # the parser and the path, so we can later look up the package.  It is
+    # looking for the name of the package and its dependencies.  We then save
+    # that off, along with the path, so we can later look up the package.  It is
     # slightly unfortunate that we end up parsing *all* the package.xml files
     # here, as we will only use a small fraction of them.  But this is the only
     # foolproof method to get the proper package names.
 
+    dep_tags_to_consider = ('depend', 'exec_depend')
+    if args.include_build_deps:
+        dep_tags_to_consider += ('build_depend',)
+
+    # Excluded packages are never examined, so don't bother parsing their
+    # dependencies or keeping them around.
+    exclude = set(args.exclude)
+
     package_name_to_package = {}
-    for (dirpath, dirnames, filenames) in os.walk(args.source_path):
-        if 'package.xml' not in filenames:
+    for package_xml_path in find_package_xmls(args.source_path):
+        (name, deps) = parse_package_xml(package_xml_path, dep_tags_to_consider, exclude)
+        if name is None or name in exclude:
             continue
 
-        tree = lxml.etree.parse(os.path.join(dirpath, 'package.xml'))
-        for child in tree.getroot().getchildren():
-            if child.tag != 'name':
-                continue
-
-            package_name_to_package[child.text] = Package(
-                child.text,
-                os.path.join(dirpath, 'QUALITY_DECLARATION.md'),
-                tree)
-            break
+        package_name_to_package[name] = Package(
+            name,
+            os.path.join(os.path.dirname(package_xml_path), 'QUALITY_DECLARATION.md'),
+            deps)
 
     args.func(args, package_name_to_package)
 